@@ -1,8 +1,17 @@
-COMMAND_ID_GET_OLD_APN = 1045
-COMMAND_ID_GET_NEW_APN_HEX = 1076
-COMMAND_ID_GET_OLD_MAIN_HOST = 1043
-COMMAND_ID_GET_NEW_MAIN_HOST_HEX = 1074
-COMMAND_ID_GET_OLD_ALT_HOST = 1044
-COMMAND_ID_GET_NEW_ALT_HOST_HEX = 1075
+from collections import namedtuple
 
-COMMAND_ID_SET_NEW_PORTS = 861
\ No newline at end of file
+Commands = namedtuple("Commands", ["GET_OLD_APN",
+                                   "GET_NEW_APN_HEX",
+                                   "GET_OLD_MAIN_HOST",
+                                   "GET_NEW_MAIN_HOST_HEX",
+                                   "GET_OLD_ALT_HOST",
+                                   "GET_NEW_ALT_HOST_HEX",
+                                   "SET_NEW_PORTS"])
+
+CMD = Commands(GET_OLD_APN=1045,
+               GET_NEW_APN_HEX=1076,
+               GET_OLD_MAIN_HOST=1043,
+               GET_NEW_MAIN_HOST_HEX=1074,
+               GET_OLD_ALT_HOST=1044,
+               GET_NEW_ALT_HOST_HEX=1075,
+               SET_NEW_PORTS=861)
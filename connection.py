@@ -1,85 +1,185 @@
 """
-Defines a class to handle our connections in a sensible and thread-safe manner.
+Defines a class to handle our connections in a sensible and thread-safe manner, using a pool of connections so that
+threads do not have to queue up behind each other to use the database.
 """
 
-from threading import Lock, active_count
+from contextlib import contextmanager
+from threading import Lock, Event, Thread
+import functools
 import logging
 import time
 
 import pymysql
+from dbutils.pooled_db import PooledDB
 
 import es_auth
 
-from cmd_ids import *
+from cmd_ids import CMD
 
 LOG = logging.getLogger("update_config")
 
 
-# A decorator to allow us to make functions thread-safe
-def synchronised(method):
-    def _wrapper(*args, **kwargs):
-        self = args[0]
-        self._lock.acquire()
-        ret = method(*args, **kwargs)
-        self._lock.release()
-        return ret
-    return _wrapper
+# Only a couple of batch sizes are ever used, so build the statement for each of them once
+@functools.lru_cache(maxsize=None)
+def _insert_pending_commands_sql(count):
+    """
+    Build the INSERT statement which adds count pending commands for a single Zephyr. Its parameters are
+    (zephyrName, commandId) for each command in turn.
+    :param count:
+    :return:
+    """
+    # The following SQL command is taken from the definition of addActivePendingCommand.
+    values = ", ".join(["(0, (SELECT id_pod FROM pod WHERE serialNumber = %s), %s, now(), 0)"] * count)
+    return f"""INSERT INTO pendingCommands (status, id_pod, id_libraryCommand, insertionDateTime, repetition)
+               VALUES {values}"""
+
+
+class ResponseCheckException(Exception):
+    pass
+
+
+class PendingCommandIdException(Exception):
+    pass
 
 
 class DBConnection:
-    # Number of times a connection has to sleep before the length of time of the sleep is increased
-    # This is multiplied by the number of Zephyrs active, so the connection wait time should increase after
-    # every Zephyr has SLEEP_TIME_PATIENCE checks
-    SLEEP_TIME_PATIENCE = 10
+    # How many seconds the watcher thread first waits between checks of the executedCommands table
+    SLEEP_TIME_INITIAL = 0.3
 
-    # By how many seconds will the sleep time increase
-    SLEEP_TIME_INCREMENT = 5
+    # By what factor the sleep time grows after each check which finds nothing new
+    SLEEP_TIME_BACKOFF = 1.25
 
     # The maximum sleep time permitted
-    SLEEP_TIME_MAX = 60*10
+    SLEEP_TIME_MAX = 3
+
+    # How many seconds get_command_response will wait for a response before giving up
+    RESPONSE_TIMEOUT = 60*60*6
+
+    # How many checks of executedCommands in a row can fail before everyone waiting is given the error
+    MAX_CONSECUTIVE_FAILURES = 5
+
+    # The maximum number of database connections open at once. Threads wanting a connection beyond this will wait
+    # for one to be returned to the pool.
+    MAX_CONNECTIONS = 32
 
     def __init__(self):
-        self._lock = Lock()
-        self._connection = pymysql.connect(user=es_auth._get_creds("dbPOD_write")["user"],
-                                          password=es_auth._get_creds("dbPOD_write")["password"],
-                                          host=es_auth._get_creds("dbPOD_write")["host"],
-                                          database=es_auth._get_creds("dbPOD_write")["db"])
-        self._sleep_time = 10
-        self._attempts_at_sleep_time = 0
+        creds = es_auth._get_creds("dbPOD_write")
+        # Every statement we run stands alone, so let each one commit itself. This means a SELECT never sees a stale
+        # snapshot, and connections don't need a ROLLBACK when returned to the pool.
+        # Don't ping connections when they are checked out, as that would be an extra round-trip for every query. If a
+        # connection has gone away, DBUtils reopens it and retries when the query fails.
+        self._pool = PooledDB(creator=pymysql, mincached=2, maxcached=8, maxconnections=self.MAX_CONNECTIONS,
+                              blocking=True, reset=False, ping=0,
+                              autocommit=True,
+                              user=creds["user"],
+                              password=creds["password"],
+                              host=creds["host"],
+                              database=creds["db"])
+
+        # Pending command IDs which somebody is waiting on, mapped to the Event set when the response arrives,
+        # and the responses (or errors from checking for them) which have arrived but not yet been collected
+        self._waiters_lock = Lock()
+        self._waiters = {}
+        self._results = {}
+        self._errors = {}
+        self._new_waiter = Event()
+        self._sleep_time = self.SLEEP_TIME_INITIAL
+
+        # A single thread watches executedCommands on behalf of everyone waiting on a response
+        self._watcher = Thread(target=self._watch_executed_commands, name="Thread-Watcher", daemon=True)
+        self._watcher.start()
 
     def _progress_sleep_time(self):
         """
-        If _attempts_at_sleep_time is greater than SLEEP_TIME_PATIENCE, increase it by SLEEP_TIME_INCREMENT,
-        up to a maximum of SLEEP_TIME_MAX. Increment _attempts_at_sleep_time.
+        Multiply _sleep_time by SLEEP_TIME_BACKOFF, up to a maximum of SLEEP_TIME_MAX.
 
         Used for the process of gradually making requests less and less frequently
         :return:
         """
-        self._attempts_at_sleep_time += 1
+        self._sleep_time = min(self._sleep_time * self.SLEEP_TIME_BACKOFF, self.SLEEP_TIME_MAX)
+
+    @contextmanager
+    def _cursor(self):
+        """
+        Check a connection out of the pool and yield a cursor on it. The connection is always returned to the pool,
+        even if an exception is raised.
+        :return:
+        """
+        connection = self._pool.connection()
+        try:
+            with connection.cursor() as c:
+                yield c
+        finally:
+            connection.close()
+
+    def _fetch_responses(self, pending_command_ids):
+        """
+        Fetch any responses which have arrived for the given pending commands.
+        :param pending_command_ids:
+        :return: A list of (id_pendingCommand, response) tuples.
+        """
+        # This relies on the index on executedCommands.id_pendingCommand in executed_commands_index.sql
+        placeholders = ", ".join(["%s"] * len(pending_command_ids))
+        with self._cursor() as c:
+            c.execute(f"""SELECT id_pendingCommand, response FROM executedCommands
+                          WHERE id_pendingCommand IN ({placeholders})""",
+                      pending_command_ids)
+            results = c.fetchall()
+            # Responses can be long EEPROM readouts, so only log how many there were. thread_zephyr logs the responses.
+            if LOG.isEnabledFor(logging.DEBUG):
+                LOG.debug("Searching for %d pending commands, found %d responses", len(pending_command_ids),
+                          len(results))
+        return results
+
+    def _watch_executed_commands(self):
+        """
+        Runs forever in the watcher thread, checking executedCommands for responses to every pending command which is
+        being waited on, and waking up the waiting thread when its response arrives.
+        :return:
+        """
+        consecutive_failures = 0
+        while True:
+            with self._waiters_lock:
+                pending_command_ids = list(self._waiters.keys())
+
+            if len(pending_command_ids) == 0:
+                # Nobody is waiting on anything, so don't bother the database until somebody is
+                self._new_waiter.wait()
+                self._new_waiter.clear()
+                continue
+
+            try:
+                results = self._fetch_responses(pending_command_ids)
+                consecutive_failures = 0
+            except Exception as err:
+                consecutive_failures += 1
+                LOG.warning("Failed to check for command responses (%d in a row): %r", consecutive_failures, err)
+                results = []
 
-        if self._sleep_time >= self.SLEEP_TIME_MAX:
-            # Already at the maximum sleep time
-            return
+                if consecutive_failures >= self.MAX_CONSECUTIVE_FAILURES:
+                    # This doesn't look like it's going away, so give up on everything currently being waited on
+                    # rather than leaving it all to time out
+                    with self._waiters_lock:
+                        for pending_command_id, event in self._waiters.items():
+                            self._errors[pending_command_id] = err
+                            event.set()
+                        self._waiters.clear()
+                    consecutive_failures = 0
 
-        if self._attempts_at_sleep_time >= self.SLEEP_TIME_PATIENCE * (active_count()-1):
-            self._attempts_at_sleep_time = 0
-            self._sleep_time += self.SLEEP_TIME_INCREMENT
-            LOG.debug(f"Increasing sleep time to {self._sleep_time}")
+            with self._waiters_lock:
+                for pending_command_id, response in results:
+                    if pending_command_id in self._waiters:
+                        self._results[pending_command_id] = response
+                        self._waiters.pop(pending_command_id).set()
 
+            if len(results) == 0:
+                self._progress_sleep_time()
+            else:
+                self._sleep_time = self.SLEEP_TIME_INITIAL
 
-    # An unsynchronised version, to be used by synchronised functions
-    def _send_command_to_zephyr(self, commandId, zephyrName):
-        # The following SQL command is taken from the definition of addActivePendingCommand.
-        with self._connection.cursor() as c:
-            c.execute(
-                """INSERT INTO pendingCommands (status, id_pod, id_libraryCommand, insertionDateTime, repetition)
-                   VALUES (0, (SELECT id_pod FROM pod WHERE serialNumber = %s), %s, now(), 0)""",
-                (zephyrName, commandId))
-            LOG.debug(f"Queued command {commandId} to Zephyr {zephyrName}")
-        self._connection.commit()
-        return c.lastrowid
+            self._new_waiter.wait(self._sleep_time)
+            self._new_waiter.clear()
 
-    @synchronised
     def send_command_to_zephyr(self, commandId, zephyrName):
         """
         Sends a command of the given ID to the Zephyr.
@@ -87,7 +187,36 @@ class DBConnection:
         :param zephyrName:
         :return: The ID in the pendingCommands table of the new command.
         """
-        return self._send_command_to_zephyr(commandId, zephyrName)
+        return self.send_commands_to_zephyr([commandId], zephyrName)[0]
+
+    def send_commands_to_zephyr(self, commandIds, zephyrName):
+        """
+        Sends commands of the given IDs to the Zephyr, in a single INSERT.
+        :param commandIds:
+        :param zephyrName:
+        :return: The IDs in the pendingCommands table of the new commands, in the same order as commandIds.
+        """
+        params = [param for commandId in commandIds for param in (zephyrName, commandId)]
+        with self._cursor() as c:
+            c.execute(_insert_pending_commands_sql(len(commandIds)), params)
+            first_id = c.lastrowid
+            LOG.debug("Queued commands %s to Zephyr %s", commandIds, zephyrName)
+
+            if len(commandIds) == 1:
+                return [first_id]
+
+            # MySQL doesn't promise consecutive IDs to a multi-row INSERT containing a subquery when other INSERTs are
+            # running at the same time, so read back the IDs we were actually given. lastrowid is the first of them.
+            c.execute("""SELECT id_pendingCommand, id_libraryCommand FROM pendingCommands
+                         WHERE id_pendingCommand >= %s AND id_pod = (SELECT id_pod FROM pod WHERE serialNumber = %s)
+                         ORDER BY id_pendingCommand LIMIT %s""",
+                      (first_id, zephyrName, len(commandIds)))
+            rows = c.fetchall()
+
+        if [row[1] for row in rows] != list(commandIds):
+            raise PendingCommandIdException(f"Queued commands {commandIds} to Zephyr {zephyrName}, but found "
+                                            f"{rows} in pendingCommands from ID {first_id}")
+        return [row[0] for row in rows]
 
     def get_command_response(self, pending_command_id):
         """
@@ -96,31 +225,53 @@ class DBConnection:
         :param pending_command_id:
         :return:
         """
-        while True:
-            # First, search the executedCommands table for a row with id_pendingCommand = pending_command_id.
-            self._lock.acquire()
-            with self._connection.cursor() as c:
-                c.execute("""SELECT response FROM executedCommands WHERE id_pendingCommand = %s""",
-                          (pending_command_id,))
-                results = list(c)
-                LOG.debug(f"Searching for pending command {pending_command_id}, found results {results}")
-            self._connection.commit()
-            self._lock.release()
-
-            # Did we get a result?
-            if len(results) != 0:
-                return results[0][0]
-
-            # We didn't get any results. Sleep for a while and try again.
-            self._progress_sleep_time()
-            time.sleep(self._sleep_time)
-
-    @synchronised
+        return self.get_command_responses([pending_command_id])[pending_command_id]
+
+    def get_command_responses(self, pending_command_ids):
+        """
+        A blocking function which waits until all of the given pending commands have been executed, and then returns
+        the responses from the Zephyr.
+        :param pending_command_ids:
+        :return: A dictionary mapping each pending command ID to its response.
+        :raises ResponseCheckException: If checking executedCommands kept failing while waiting.
+        """
+        events = {pending_command_id: Event() for pending_command_id in pending_command_ids}
+        with self._waiters_lock:
+            self._waiters.update(events)
+        # Start checking aggressively again, since these commands may be answered quickly
+        self._sleep_time = self.SLEEP_TIME_INITIAL
+        self._new_waiter.set()
+
+        # The timeout applies to the whole set of commands, not to each one
+        deadline = time.monotonic() + self.RESPONSE_TIMEOUT
+        for event in events.values():
+            if not event.wait(max(0, deadline - time.monotonic())):
+                break
+
+        with self._waiters_lock:
+            for pending_command_id in pending_command_ids:
+                self._waiters.pop(pending_command_id, None)
+            errors = [self._errors.pop(pending_command_id)
+                      for pending_command_id in pending_command_ids if pending_command_id in self._errors]
+            responses = {pending_command_id: self._results.pop(pending_command_id)
+                         for pending_command_id in pending_command_ids if pending_command_id in self._results}
+
+        if len(errors) != 0:
+            raise ResponseCheckException(f"Unable to check for responses to pending commands "
+                                         f"{pending_command_ids}") from errors[0]
+
+        missing = [pending_command_id for pending_command_id in pending_command_ids
+                   if pending_command_id not in responses]
+        if len(missing) != 0:
+            raise TimeoutError(f"No response to pending commands {missing} after {self.RESPONSE_TIMEOUT} seconds")
+
+        return responses
+
     def set_ports(self, zephyrName):
         """
         Set the v2.5-style ports of the given Zephyr
         :param zephyrName:
         :return:
         """
-        self._send_command_to_zephyr(COMMAND_ID_SET_NEW_PORTS, zephyrName)
+        self.send_command_to_zephyr(CMD.SET_NEW_PORTS, zephyrName)
         LOG.info("Sent command to set ports")
\ No newline at end of file
@@ -0,0 +1,4 @@
+-- Index used by DBConnection to look up responses in executedCommands by their pending command.
+-- Run once against dbPOD before using the tool; it only needs creating if it doesn't already exist.
+-- This is not UNIQUE, as a pending command could in principle be executed more than once.
+CREATE INDEX idx_pending ON executedCommands (id_pendingCommand);
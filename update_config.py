@@ -18,6 +18,7 @@ set the new versions.
 # To run
 Modify the main() call at the beginning of this file, and then run it. Configure apn_whitelist.txt and
 server_whitelist.txt before running, but updates will be recognised if they are modified during program running.
+Make sure the index in executed_commands_index.sql exists, or every check for responses will scan executedCommands.
 
 The main logging output provides a narrative, which is also printed in log.txt (this does not overwrite with each run).
 The files Success.txt and Failure.txt are populated with units which have either successful or unsuccessfully finished
@@ -25,33 +26,55 @@ their execution, but these are overwritten with each execution, so be careful.
 """
 import threading
 from collections import deque, namedtuple
-from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
 import logging
-import re
 from enum import Enum
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import functools
+import os
+import queue
 import sys
 
 from connection import DBConnection
-from cmd_ids import *
+from cmd_ids import CMD
 
-# Set up the logger
+# Set up the logger. This is shared with connection.py, which gets the same logger by name.
+# Only add the handlers once, in case this module is imported more than once (e.g. as __main__ and update_config).
 LOG = logging.getLogger("update_config")
 LOG.setLevel(logging.DEBUG)
-stderr_handler = logging.StreamHandler(sys.stderr)
-stderr_handler.setFormatter(logging.Formatter("%(asctime)s - %(threadName)s - %(levelname)s - %(message)s"))
-stderr_handler.setLevel(logging.DEBUG)
-LOG.addHandler(stderr_handler)
-file_handler = logging.FileHandler("log.txt", mode="a")
-file_handler.setFormatter(logging.Formatter("%(asctime)s - %(threadName)s - %(levelname)s - %(message)s"))
-file_handler.setLevel(logging.DEBUG)
-LOG.addHandler(file_handler)
-
-
-# Create our connection. Our Connection class does all of the SQL work, and handles thread-safe operation.
+LOG.propagate = False
+# The Zephyr threads only put records on a queue, and a single listener thread writes them out to stderr and log.txt.
+if not LOG.handlers:
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setFormatter(logging.Formatter("%(asctime)s - %(threadName)s - %(levelname)s - %(message)s"))
+    stderr_handler.setLevel(logging.DEBUG)
+    file_handler = logging.FileHandler("log.txt", mode="a")
+    file_handler.setFormatter(logging.Formatter("%(asctime)s - %(threadName)s - %(levelname)s - %(message)s"))
+    file_handler.setLevel(logging.DEBUG)
+
+    log_queue = queue.Queue(-1)
+    LOG.addHandler(QueueHandler(log_queue))
+    log_listener = QueueListener(log_queue, stderr_handler, file_handler, respect_handler_level=True)
+    log_listener.start()
+    # Make sure everything queued is written out before the program exits
+    atexit.register(log_listener.stop)
+
+
+# Create our connection. Our Connection class does all of the SQL work, and handles thread-safe operation using a pool
+# of database connections.
 CONNECTION = DBConnection()
 
-EXPECTED_APN_COMMAND_FORMAT = re.compile(r"""AT\+CSTT=(\".*\",\".*\",\".*\")""")
-EXPECTED_SERVER_COMMAND_FORMAT = re.compile(r"AT\+CIPSTART=\"TCP\",\"(.*)\",\".*\"")
+# The fixed beginnings of the old-style AT commands, which are followed by the values we want
+APN_COMMAND_PREFIX = "AT+CSTT="
+SERVER_COMMAND_PREFIX = "AT+CIPSTART=\"TCP\",\""
+
+# The maximum number of Zephyrs processed at once. A thread spends nearly all of its time waiting for its Zephyr to
+# respond, holding no database connection, so every Zephyr should normally get its own thread straight away; otherwise
+# units at the back of the list wouldn't get their commands queued until those in front had responded. This is only a
+# sanity limit on the number of OS threads.
+MAX_ZEPHYR_THREADS = 1000
 
 SUCCESS_FILE = open("success.txt", "wt")
 FAILURE_FILE = open("failure.txt", "wt")
@@ -77,40 +100,76 @@ class ServerType(Enum):
 
 
 
+APN_WHITELIST_PATH = "apn_whitelist.txt"
+SERVER_WHITELIST_PATH = "server_whitelist.txt"
+
+
+def _maybe_int(s):
+    """
+    Return s as an int, or None if it isn't one (e.g. "None" in the server whitelist).
+    :param s:
+    :return:
+    """
+    s = s.strip()
+    return int(s) if s.isdecimal() or (s[:1] in "+-" and s[1:].isdecimal()) else None
+
+
+@functools.lru_cache(maxsize=4)
+def _load_apn_dict(path, mtime_ns):
+    """
+    Parse the APN whitelist at path. The modification time is only taken so that the cache is invalidated when the
+    file changes.
+    :param path:
+    :param mtime_ns:
+    :return:
+    """
+    apns = {}
+    with open(path, "rt") as f:
+        for l in f:
+            if l.strip():
+                apn, command_id, *_ = l.split(":")
+                apns[apn] = int(command_id)
+    return apns
+
+
 def get_apn_dict():
     """
     Return a dictionary mapping APN to command library ID, based on the colon-separated apn_whitelist.txt.
+    The file is only re-read if it has been modified since it was last read.
     :return:
     """
-    with open("apn_whitelist.txt", "rt") as f:
-        apns = {l.split(":")[0]: int(l.split(":")[1]) for l in f.readlines() if l.strip()}
-    return apns
+    return _load_apn_dict(APN_WHITELIST_PATH, os.stat(APN_WHITELIST_PATH).st_mtime_ns)
 
 
-def get_server_dict():
+@functools.lru_cache(maxsize=4)
+def _load_server_dict(path, mtime_ns):
     """
-    Return a dictionary mapping server to a tuple of (command ID to set main, command ID to set alt), based on
-    the colon-separated server_whitelist.txt.
+    Parse the server whitelist at path. The modification time is only taken so that the cache is invalidated when the
+    file changes.
+    :param path:
+    :param mtime_ns:
     :return:
     """
     servers = {}
-    with open("server_whitelist.txt", "rt") as f:
-        for line in f.readlines():
-            parts = line.split(":")
-            key = parts[0]
+    with open(path, "rt") as f:
+        for line in f:
+            if not line.strip():
+                continue
+
+            # Pad out the line in case the alt command (or both commands) are missing entirely
+            key, main_server_command, alt_server_command = (line.rstrip("\n").split(":") + ["", ""])[:3]
+            servers[key] = (_maybe_int(main_server_command), _maybe_int(alt_server_command))
+    return servers
 
-            try:
-                main_server_command = int(parts[1])
-            except ValueError:
-                main_server_command = None
 
-            try:
-                alt_server_command = int(parts[2])
-            except ValueError:
-                alt_server_command = None
-
-            servers[key] = (main_server_command, alt_server_command)
-    return servers
+def get_server_dict():
+    """
+    Return a dictionary mapping server to a tuple of (command ID to set main, command ID to set alt), based on
+    the colon-separated server_whitelist.txt.
+    The file is only re-read if it has been modified since it was last read.
+    :return:
+    """
+    return _load_server_dict(SERVER_WHITELIST_PATH, os.stat(SERVER_WHITELIST_PATH).st_mtime_ns)
 
 
 def get_nt_string_from_hex(hex_string):
@@ -123,24 +182,54 @@ def get_nt_string_from_hex(hex_string):
     :return:
     """
     hex_string = hex_string.strip()
-    b = []
-    for i in range(0, len(hex_string), 2):
-        b.append(int(hex_string[i:i+2], 16))
+    data = bytes.fromhex(hex_string[:len(hex_string) // 2 * 2])
+    if len(hex_string) % 2 == 1:
+        # A readout with an odd number of digits ends in a lone digit, which is taken as a byte on its own
+        data += bytes([int(hex_string[-1], 16)])
 
-    # Find the first zero, and remove everything after it
-    try:
-        zero_index = b.index(0x00)
-        del b[zero_index:]
-    except ValueError:
-        pass
+    # Everything before the first zero is what we actually want. Latin-1 maps each byte to the character of the
+    # same value.
+    return data.split(b"\x00", 1)[0].decode("latin-1")
+
+
+def parse_old_apn_command(old_apn_command):
+    """
+    Extract <apn-and-password> from an old-style APN command of the form AT+CSTT=<apn-and-password>, where
+    <apn-and-password> looks like "apn","user","password". Anything on the line after the closing quote (e.g. EEPROM
+    padding) is ignored.
+    :param old_apn_command:
+    :return: The APN and password, or None if the command isn't formatted correctly.
+    """
+    if not old_apn_command.startswith(APN_COMMAND_PREFIX):
+        return None
 
-    # Everything left is what we actually want
-    s = ""
-    for byte in b:
-        s += chr(byte)
+    # The value runs from the opening quote up to the last quote on the line
+    line = old_apn_command[len(APN_COMMAND_PREFIX):].partition("\n")[0]
+    apn_and_password = line[:line.rfind("\"") + 1]
+    if len(apn_and_password) < 2 or not apn_and_password.startswith("\"") \
+            or apn_and_password[1:-1].count("\",\"") < 2:
+        return None
+    return apn_and_password
 
-    # Return the string
-    return s
+
+def parse_old_server_command(old_command):
+    """
+    Extract <server> from an old-style server command of the form AT+CIPSTART="TCP","<server>","<port>". Anything on
+    the line after the closing quote (e.g. EEPROM padding) is ignored.
+    :param old_command:
+    :return: The server, or None if the command isn't formatted correctly.
+    """
+    if not old_command.startswith(SERVER_COMMAND_PREFIX):
+        return None
+
+    # <server> runs up to the last "," on the line which has a closing quote for the port somewhere after it
+    line = old_command[len(SERVER_COMMAND_PREFIX):].partition("\n")[0]
+    separator_index = line.rfind("\",\"")
+    if separator_index != -1 and "\"" not in line[separator_index + 3:]:
+        separator_index = line.rfind("\",\"", 0, separator_index + 2)
+    if separator_index == -1:
+        return None
+    return line[:separator_index]
 
 
 def thread_zephyr_wrapper(serialNumber):
@@ -149,10 +238,12 @@ def thread_zephyr_wrapper(serialNumber):
     :param serialNumber:
     :return:
     """
+    # Pool threads are reused, so name this one after the Zephyr it is now working on for the logs
+    threading.current_thread().name = "Thread-" + serialNumber
     try:
         thread_zephyr(serialNumber)
     except Exception as err:
-        LOG.exception(f"Exception while processing Zephyr {serialNumber}", exc_info=err)
+        LOG.exception("Exception while processing Zephyr %s", serialNumber, exc_info=err)
 
         with FAILURE_FILE_LOCK:
             print(serialNumber, file=FAILURE_FILE, flush=True)
@@ -166,62 +257,67 @@ def thread_zephyr(serialNumber):
     """
 
     # Start off by sending the commands to read the old values
-    pending_id_get_old_apn = CONNECTION.send_command_to_zephyr(COMMAND_ID_GET_OLD_APN, serialNumber)
-    LOG.debug("Sent GET_OLD_APN command")
-    pending_id_get_new_apn = CONNECTION.send_command_to_zephyr(COMMAND_ID_GET_NEW_APN_HEX, serialNumber)
-    LOG.debug("Sent GET_NEW_APN_HEX command")
-    pending_id_get_old_main_host = CONNECTION.send_command_to_zephyr(COMMAND_ID_GET_OLD_MAIN_HOST, serialNumber)
-    LOG.debug("Sent GET_OLD_MAIN_HOST command")
-    pending_id_get_new_main_host = CONNECTION.send_command_to_zephyr(COMMAND_ID_GET_NEW_MAIN_HOST_HEX, serialNumber)
-    LOG.debug("Sent GET_NEW_MAIN_HOST_HEX command")
-    pending_id_get_old_alt_host = CONNECTION.send_command_to_zephyr(COMMAND_ID_GET_OLD_ALT_HOST, serialNumber)
-    LOG.debug("Sent GET_OLD_ALT_HOST command")
-    pending_id_get_new_alt_host = CONNECTION.send_command_to_zephyr(COMMAND_ID_GET_NEW_ALT_HOST_HEX, serialNumber)
-    LOG.debug("Sent GET_NEW_ALT_HOST_HEX command")
+    (pending_id_get_old_apn,
+     pending_id_get_new_apn,
+     pending_id_get_old_main_host,
+     pending_id_get_new_main_host,
+     pending_id_get_old_alt_host,
+     pending_id_get_new_alt_host) = CONNECTION.send_commands_to_zephyr([CMD.GET_OLD_APN,
+                                                                        CMD.GET_NEW_APN_HEX,
+                                                                        CMD.GET_OLD_MAIN_HOST,
+                                                                        CMD.GET_NEW_MAIN_HOST_HEX,
+                                                                        CMD.GET_OLD_ALT_HOST,
+                                                                        CMD.GET_NEW_ALT_HOST_HEX], serialNumber)
     LOG.info("Sent all commands to get information")
 
-    # Get the responses - These functions are blocking but only the first one practically should
+    # Wait for all of the responses at once, so we are only woken up when the last of them arrives
     # Responses to QN and QE commands begin with a '0' character, so we have to cut it off
-    old_apn_command = CONNECTION.get_command_response(pending_id_get_old_apn)[1:]
-    LOG.info(f"Old APN command is {old_apn_command}")
-    new_apn = get_nt_string_from_hex(CONNECTION.get_command_response(pending_id_get_new_apn)[1:])
-    LOG.info(f"Current new APN command is {new_apn}")
-    old_main_command = CONNECTION.get_command_response(pending_id_get_old_main_host)[1:]
-    LOG.info(f"Old main server command is {old_main_command}")
-    new_main = get_nt_string_from_hex(CONNECTION.get_command_response(pending_id_get_new_main_host)[1:])
-    LOG.info(f"Current new main server command is {new_main}")
-    old_alt_command = CONNECTION.get_command_response(pending_id_get_old_alt_host)[1:]
-    LOG.info(f"Old alt server command is {old_alt_command}")
-    new_alt = get_nt_string_from_hex(CONNECTION.get_command_response(pending_id_get_new_alt_host)[1:])
-    LOG.info(f"Current new alt server command is {new_alt}")
+    responses = CONNECTION.get_command_responses([pending_id_get_old_apn,
+                                                  pending_id_get_new_apn,
+                                                  pending_id_get_old_main_host,
+                                                  pending_id_get_new_main_host,
+                                                  pending_id_get_old_alt_host,
+                                                  pending_id_get_new_alt_host])
+    old_apn_command = responses[pending_id_get_old_apn][1:]
+    LOG.info("Old APN command is %s", old_apn_command)
+    new_apn = get_nt_string_from_hex(responses[pending_id_get_new_apn][1:])
+    LOG.info("Current new APN command is %s", new_apn)
+    old_main_command = responses[pending_id_get_old_main_host][1:]
+    LOG.info("Old main server command is %s", old_main_command)
+    new_main = get_nt_string_from_hex(responses[pending_id_get_new_main_host][1:])
+    LOG.info("Current new main server command is %s", new_main)
+    old_alt_command = responses[pending_id_get_old_alt_host][1:]
+    LOG.info("Old alt server command is %s", old_alt_command)
+    new_alt = get_nt_string_from_hex(responses[pending_id_get_new_alt_host][1:])
+    LOG.info("Current new alt server command is %s", new_alt)
 
     # Read in the APN whitelist
-    # We read this in from the file every time so that theoretically we could add to the
-    #  whitelists during the running of the program.
+    # We check the file every time so that theoretically we could add to the whitelists during the running of the
+    #  program. It is only parsed again if it has changed.
     apns = get_apn_dict()
-    LOG.debug(f"Read APN whitelist: {apns}")
+    LOG.debug("Read APN whitelist: %s", apns)
 
     # First, check the APN.
     if new_apn[:-2] not in apns.keys():
         set_new_apn(serialNumber, old_apn_command, apns)
     else:
-        LOG.info(f"New APN {new_apn} already acceptable")
+        LOG.info("New APN %s already acceptable", new_apn)
 
     # Read in the server whitelist
     servers = get_server_dict()
-    LOG.debug(f"Read server whitelist: {servers}")
+    LOG.debug("Read server whitelist: %s", servers)
 
     # Check the main server
     if new_main not in servers.keys():
         set_server(serialNumber, old_main_command, servers, ServerType.MAIN)
     else:
-        LOG.info(f"New main server {new_main} is already acceptable")
+        LOG.info("New main server %s is already acceptable", new_main)
 
     # Check the alt server
     if new_alt not in servers.keys():
         set_server(serialNumber, old_alt_command, servers, ServerType.ALT)
     else:
-        LOG.info(f"New alt server {new_alt} is already acceptable")
+        LOG.info("New alt server %s is already acceptable", new_alt)
 
     # Set main port
     CONNECTION.set_ports(serialNumber)
@@ -243,15 +339,13 @@ def set_new_apn(serialNumber: str, old_apn_command: str, apns: "dict"):
 
     # old_apn_command should have the form AT+CSTT=<apn-and-password>
     # We want to set the new command to <apn-and-password>,
-    match = re.match(EXPECTED_APN_COMMAND_FORMAT, old_apn_command)
+    apn_and_password = parse_old_apn_command(old_apn_command)
 
-    if match is None:
+    if apn_and_password is None:
         # The format wasn't right
         raise APNFormattingException(f"Old APN for {serialNumber} is {old_apn_command}, not formatted correctly")
 
-    # We did actually find a match
-    apn_and_password = match.group(1)
-    LOG.info(f"Found APN and password as {apn_and_password}")
+    LOG.info("Found APN and password as %s", apn_and_password)
 
     # Check that the old-style APN is in the whitelist
     if apn_and_password not in apns.keys():
@@ -259,9 +353,9 @@ def set_new_apn(serialNumber: str, old_apn_command: str, apns: "dict"):
 
     # The apn/password we have here is in the whitelist, so we should send the command to set it
     set_apn_command_id = apns[apn_and_password]
-    LOG.debug(f"Command to set APN is {set_apn_command_id}")
+    LOG.debug("Command to set APN is %s", set_apn_command_id)
     CONNECTION.send_command_to_zephyr(set_apn_command_id, serialNumber)
-    LOG.info(f"Queued up command to set APN to {apn_and_password}")
+    LOG.info("Queued up command to set APN to %s", apn_and_password)
 
 
 
@@ -275,58 +369,61 @@ def set_server(serialNumber: str, old_command: str, servers: dict, main_or_alt:
     :param main_or_alt:
     :return:
     """
-    LOG.debug(f"Starting to set new {'main' if main_or_alt == ServerType.MAIN else 'alt'} server")
+    label = "main" if main_or_alt == ServerType.MAIN else "alt"
+    LOG.debug("Starting to set new %s server", label)
 
     # old_main_command should have the form AT+CIPSTART="TCP","<server>","port"
     # We just want to extract <server>
-    match = re.match(EXPECTED_SERVER_COMMAND_FORMAT, old_command)
+    server = parse_old_server_command(old_command)
 
-    if match is None:
+    if server is None:
         # The format wasn't right
-        raise ServerFormattingException(f"Old {'main' if main_or_alt == ServerType.MAIN else 'alt'} server for "
-                                        f"{serialNumber} is {old_command}, not formatted correctly")
+        raise ServerFormattingException(f"Old {label} server for {serialNumber} is {old_command}, "
+                                        f"not formatted correctly")
 
-    # We found a match
-    server = match.group(1)
-    LOG.info(f"Found {'main' if main_or_alt == ServerType.MAIN else 'alt'} server as {server}")
+    LOG.info("Found %s server as %s", label, server)
 
     # Check that the server is in the whitelist
     if server not in servers.keys():
-        raise ServerWhitelistException(f"Old {'main' if main_or_alt == ServerType.MAIN else 'alt'} server for "
-                                       f"{serialNumber} is {server}, not in whitelist")
+        raise ServerWhitelistException(f"Old {label} server for {serialNumber} is {server}, not in whitelist")
 
     # The server is in the whitelist, so we can set the right server properly
-    if main_or_alt == ServerType.MAIN:
-        set_server_command_id = servers[server][0]
-    else:
-        set_server_command_id = servers[server][1]
-    LOG.debug(f"Command to set {'main' if main_or_alt == ServerType.MAIN else 'alt'} server is {set_server_command_id}")
+    # The whitelist gives (main command, alt command), in the same order as the ServerType values
+    set_server_command_id = servers[server][main_or_alt.value]
+    LOG.debug("Command to set %s server is %s", label, set_server_command_id)
     if set_server_command_id is None:
         # This server option is unavailable for this choice of main vs alt
         # (e.g. there is no command to set the alt server to AQ76)
-        raise ServerWhitelistException(f"Unable to set {'main' if main_or_alt == ServerType.MAIN else 'alt'} server "
-                                       f"for {serialNumber} to {server}, as that option is unavailable")
+        raise ServerWhitelistException(f"Unable to set {label} server for {serialNumber} to {server}, "
+                                       f"as that option is unavailable")
 
     CONNECTION.send_command_to_zephyr(set_server_command_id, serialNumber)
-    LOG.info(f"Queued up command to set {'main' if main_or_alt == ServerType.MAIN else 'alt'} server to {server}")
+    LOG.info("Queued up command to set %s server to %s", label, server)
 
 
 
 
 def main(zephyrs: "list[str]"):
     """
-    Run the program. This starts a new thread for every Zephyr.
+    Run the program. This processes the Zephyrs on a pool of threads, one per Zephyr (up to MAX_ZEPHYR_THREADS), and
+    returns once they have all finished.
     :param zephyrs:
     :return:
     """
+    if len(zephyrs) == 0:
+        return
 
-    for zephyr in zephyrs:
-        Thread(target=thread_zephyr_wrapper, args=(zephyr,), name="Thread-"+zephyr).start()
-        LOG.info(f"Started thread for Zephyr {zephyr}")
+    with ThreadPoolExecutor(max_workers=min(MAX_ZEPHYR_THREADS, len(zephyrs)), thread_name_prefix="Zephyr") as ex:
+        futures = {ex.submit(thread_zephyr_wrapper, zephyr): zephyr for zephyr in zephyrs}
+        LOG.info("Queued %s Zephyrs", len(futures))
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                LOG.exception("Zephyr %s failed", futures[future], exc_info=err)
 
-    if threading.active_count() == 1:
-        # All the above threads have finished
-        LOG.info("ALL ZEPHYRS FINISHED")
+    LOG.info("ALL ZEPHYRS FINISHED")
 
 # Testing
 if __name__ == "__main__":